@@ -15,4 +15,10 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brain_tumor_classifier.settings
 
 application = get_wsgi_application()
 
+# Load and warm up the classifier when the server starts instead of on the first prediction.
+# Only safe when this module is imported per worker, i.e. gunicorn without --preload.
+if os.environ.get('CLASSIFIER_PRELOAD') == '1':
+    from classifier.ml_service import get_classifier
+    get_classifier()
+
 app = application
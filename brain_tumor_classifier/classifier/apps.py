@@ -1,6 +1,18 @@
+import os
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ClassifierConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'classifier'
+
+    def ready(self):
+        # Output directories for Grad-CAM images and cached activations. On a read-only
+        # filesystem only Grad-CAM should fail, not the whole app and every management command.
+        for name in ('gradcam', 'gradcam_cache'):
+            try:
+                os.makedirs(os.path.join(settings.MEDIA_ROOT, name), exist_ok=True)
+            except OSError as e:
+                print(f"Could not create media directory '{name}': {e}")
@@ -1,16 +1,153 @@
+import functools
 import tensorflow as tf
 import numpy as np
 import cv2
-from PIL import Image
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-import os
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+_rng = np.random.default_rng()
+
+
+# Only a handful of image sizes are kept, so one huge upload can't pin its mask forever
+@functools.lru_cache(maxsize=4)
+def _radial_base_mask(h, w):
+    """Return the centre-weighted radial heatmap for an (h, w) image; callers must not modify it"""
+    y, x = np.ogrid[:h, :w]
+    mask = ((x - w // 2) ** 2 + (y - h // 2) ** 2).astype(np.float32)
+    return 1 - mask / max(mask.max(), 1)
+
+
+def _build_jet_lut():
+    """Sample matplotlib's 'jet' segment data into a 256x3 uint8 RGB table, without matplotlib"""
+    segments = (
+        ((0.0, 0.35, 0.66, 0.89, 1.0), (0.0, 0.0, 1.0, 1.0, 0.5)),
+        ((0.0, 0.125, 0.375, 0.64, 0.91, 1.0), (0.0, 0.0, 1.0, 1.0, 0.0, 0.0)),
+        ((0.0, 0.11, 0.34, 0.65, 1.0), (0.5, 1.0, 1.0, 0.0, 0.0)),
+    )
+    x = np.linspace(0, 1, 256)
+    lut = np.stack([np.interp(x, xp, fp) for xp, fp in segments], axis=1)
+    return (lut * 255).astype(np.uint8)
+
+
+# Jet colormap as a static 256-entry RGB table; indexing it with uint8 heatmap values colorizes them
+JET_LUT = _build_jet_lut()
+
+
+def _fuse_overlay_numpy(original_img, heatmap_u8, lut, out):
+    """Colorize the uint8 heatmap through the LUT and blend it 60/40 with the image"""
+    cv2.addWeighted(original_img, 0.6, lut[heatmap_u8], 0.4, 0, dst=out)
+
+
+# Serial and uncached on purpose: requests already run on several threads, numba's default
+# workqueue threading layer aborts on concurrent parallel launches, and an on-disk cache
+# fails at import when neither __pycache__ nor the user cache directory is writable
+if njit is not None:
+    @njit
+    def _fuse_overlay(original_img, heatmap_u8, lut, out):
+        """Colorize the uint8 heatmap through the LUT and blend it 60/40 with the image in one pass"""
+        h, w = heatmap_u8.shape
+        for i in range(h):
+            for j in range(w):
+                idx = heatmap_u8[i, j]
+                for c in range(3):
+                    # Integer 3:2 blend, rounded to nearest
+                    out[i, j, c] = (3 * np.int32(original_img[i, j, c]) + 2 * np.int32(lut[idx, c]) + 2) // 5
+else:
+    _fuse_overlay = _fuse_overlay_numpy
+
+
+def _blend_heatmap(original_img, heatmap):
+    """Overlay a [0, 1] heatmap on an RGB uint8 image, resizing it to the image first if needed"""
+    # Quantize at the heatmap's own (usually much smaller) resolution, then resize in uint8
+    heatmap_u8 = (np.nan_to_num(np.clip(heatmap, 0, 1)) * 255).astype(np.uint8)
+    h, w = original_img.shape[:2]
+    if heatmap_u8.shape != (h, w):
+        heatmap_u8 = cv2.resize(heatmap_u8, (w, h), interpolation=cv2.INTER_LINEAR)
+    
+    out = np.empty_like(original_img)
+    _fuse_overlay(np.ascontiguousarray(original_img), heatmap_u8, JET_LUT, out)
+    return out
 
 class GradCAM:
-    def __init__(self, model, layer_name=None):
+    def __init__(self, model, layer_name=None, jit_compile=False):
         self.model = model
         self.layer_name = layer_name or self._find_target_layer()
+        self.grad_model = self._build_grad_model()
+        self._compute_heatmap = None
+        self._forward = None
+        
+        if self.grad_model is not None:
+            self._forward = tf.function(
+                self._forward_graph,
+                jit_compile=jit_compile,
+                input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)]
+            )
+            self._compute_heatmap = tf.function(
+                self._heatmap_graph,
+                jit_compile=jit_compile,
+                input_signature=[
+                    tf.TensorSpec([1, 224, 224, 3], tf.float32),
+                    tf.TensorSpec([], tf.int64),
+                ]
+            )
+        
+    def _build_grad_model(self):
+        """Build the model mapping the input to the target layer activations and the predictions"""
+        if self.model is None or self.layer_name is None:
+            return None
+        
+        try:
+            target = self.model.get_layer(self.layer_name).output
+            return tf.keras.models.Model(self.model.inputs, [target, self.model.output])
+        except Exception as e:
+            print(f"Error building Grad-CAM model: {e}")
+            return None
+    
+    @property
+    def has_graph(self):
+        return self._forward is not None
+    
+    def forward_with_grads(self, img_batch):
+        """Run a batch through the model, returning the predictions and top-class Grad-CAM activations"""
+        predictions, conv_outputs, pooled_grads = self._forward(tf.convert_to_tensor(img_batch))
+        return predictions.numpy(), conv_outputs.numpy(), pooled_grads.numpy()
+    
+    @staticmethod
+    def heatmap_from_activations(conv_outputs, pooled_grads):
+        """Weight one image's (h, w, c) activations by its pooled gradients into a [0, 1] heatmap"""
+        heatmap = np.maximum(conv_outputs @ pooled_grads, 0)
+        return heatmap / max(heatmap.max(), 1e-8)
+    
+    def warmup(self, batch_sizes=(1,)):
+        """Trace and compile the Grad-CAM graphs and overlay kernel ahead of the first request
         
+        The batched forward graph is compiled for every size in batch_sizes. A graph that
+        fails to build is disabled, so callers fall back to plain classification or the
+        mock visualization instead of failing every request.
+        """
+        if self._forward is not None:
+            try:
+                for size in batch_sizes:
+                    self._forward(tf.zeros([size, 224, 224, 3], dtype=tf.float32))
+            except Exception as e:
+                print(f"Grad-CAM forward graph failed to build, disabling it: {e}")
+                self._forward = None
+        
+        if self._compute_heatmap is not None:
+            try:
+                self._compute_heatmap(tf.zeros([1, 224, 224, 3], dtype=tf.float32), tf.constant(-1, dtype=tf.int64))
+            except Exception as e:
+                print(f"Grad-CAM heatmap graph failed to build, disabling it: {e}")
+                self._compute_heatmap = None
+        
+        try:
+            _blend_heatmap(np.zeros((8, 8, 3), dtype=np.uint8), np.zeros((8, 8), dtype=np.float32))
+        except Exception as e:
+            print(f"Grad-CAM overlay warm-up failed: {e}")
+    
     def _find_target_layer(self):
         """Find the last convolutional layer in the model"""
         if self.model is None:
@@ -31,123 +168,92 @@ class GradCAM:
         except:
             return None
     
-    def generate_gradcam(self, image_path, class_index=None):
-        """Generate Grad-CAM heatmap for the given image"""
+    def generate_gradcam(self, original_img, class_index=None, img_array=None, activations=None):
+        """Generate Grad-CAM heatmap for the given RGB image"""
+        return self._generate(original_img, class_index, img_array, activations)[0]
+    
+    def _generate(self, original_img, class_index=None, img_array=None, activations=None):
+        """Generate the overlay, also reporting whether it is the mock visualization"""
         try:
-            if self.model is None or self.layer_name is None:
-                return self._generate_mock_gradcam(image_path)
-            
-            # Preprocess image
-            img_array = self._preprocess_image(image_path)
-            if img_array is None:
-                return self._generate_mock_gradcam(image_path)
-            
-            # Create a model that maps the input image to the activations of the target layer
-            grad_model = tf.keras.models.Model(
-                [self.model.inputs], 
-                [self.model.get_layer(self.layer_name).output, self.model.output]
-            )
-            
-            # Compute the gradient of the top predicted class for our input image
-            with tf.GradientTape() as tape:
-                conv_outputs, predictions = grad_model(img_array)
-                if class_index is None:
-                    class_index = tf.argmax(predictions[0])
-                class_channel = predictions[:, class_index]
+            if original_img is None:
+                return self._generate_mock_gradcam(original_img), True
             
-            # Compute gradients
-            grads = tape.gradient(class_channel, conv_outputs)
+            # Activations cached at prediction time only need the cheap weighting step
+            if activations is not None and class_index is None:
+                return self._create_overlay(original_img, self.heatmap_from_activations(*activations)), False
             
-            # Pool the gradients over all the axes leaving out the channel dimension
-            pooled_grads = tf.reduce_mean(grads, axis=(0, 1, 2))
+            if self._compute_heatmap is None:
+                return self._generate_mock_gradcam(original_img), True
             
-            # Weight the channels by the corresponding gradients
-            conv_outputs = conv_outputs[0]
-            heatmap = conv_outputs @ pooled_grads[..., tf.newaxis]
-            heatmap = tf.squeeze(heatmap)
+            # The classifier hands us the already preprocessed model input
+            if img_array is None:
+                return self._generate_mock_gradcam(original_img), True
             
-            # Normalize the heatmap
-            heatmap = tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
+            # A negative index means "use the top predicted class"
+            if class_index is None:
+                class_index = -1
+            heatmap = self._compute_heatmap(tf.convert_to_tensor(img_array), tf.constant(class_index, dtype=tf.int64))
             
-            return self._create_overlay(image_path, heatmap.numpy())
+            return self._create_overlay(original_img, heatmap.numpy()), False
             
         except Exception as e:
             print(f"Error generating Grad-CAM: {e}")
-            return self._generate_mock_gradcam(image_path)
+            return self._generate_mock_gradcam(original_img), True
     
-    def _preprocess_image(self, image_path):
-        """Preprocess image for Grad-CAM"""
-        try:
-            image = cv2.imread(image_path)
-            if image is None:
-                return None
-            
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            image = cv2.resize(image, (224, 224))
-            image = image.astype(np.float32) / 255.0
-            image = np.expand_dims(image, axis=0)
-            
-            return image
-        except:
-            return None
+    def _forward_graph(self, img_batch):
+        """Traced forward pass that also computes each image's top-class pooled gradients"""
+        with tf.GradientTape() as tape:
+            conv_outputs, predictions = self.grad_model(img_batch, training=False)
+            top_class = tf.argmax(predictions, axis=1)
+            class_channel = tf.gather(predictions, top_class, axis=1, batch_dims=1)
+        
+        # Images in a batch are independent, so each gets its own gradients
+        grads = tape.gradient(class_channel, conv_outputs)
+        pooled_grads = tf.reduce_mean(grads, axis=(1, 2))
+        return predictions, conv_outputs, pooled_grads
+    
+    def _heatmap_graph(self, img_array, class_index):
+        """Traced body of the Grad-CAM computation"""
+        # Compute the gradient of the requested class for our input image
+        with tf.GradientTape() as tape:
+            conv_outputs, predictions = self.grad_model(img_array, training=False)
+            if class_index < 0:
+                class_index = tf.argmax(predictions[0])
+            class_channel = predictions[:, class_index]
+        
+        # Compute gradients
+        grads = tape.gradient(class_channel, conv_outputs)
+        
+        # Pool the gradients over the spatial axes and weight the channels by them in one contraction
+        heatmap = tf.einsum('hwc,c->hw', conv_outputs[0], tf.reduce_mean(grads[0], axis=(0, 1)))
+        
+        # Normalize the heatmap
+        return tf.maximum(heatmap, 0) / tf.math.reduce_max(heatmap)
     
-    def _create_overlay(self, image_path, heatmap):
+    def _create_overlay(self, original_img, heatmap):
         """Create overlay of heatmap on original image"""
-        try:
-            # Load original image
-            original_img = cv2.imread(image_path)
-            original_img = cv2.cvtColor(original_img, cv2.COLOR_BGR2RGB)
-            
-            # Resize heatmap to match original image
-            heatmap_resized = cv2.resize(heatmap, (original_img.shape[1], original_img.shape[0]))
-            
-            # Convert heatmap to RGB
-            heatmap_colored = cm.jet(heatmap_resized)[:, :, :3]
-            heatmap_colored = (heatmap_colored * 255).astype(np.uint8)
-            
-            # Create overlay
-            overlay = cv2.addWeighted(original_img, 0.6, heatmap_colored, 0.4, 0)
-            
-            return overlay
-            
-        except Exception as e:
-            print(f"Error creating overlay: {e}")
-            return self._generate_mock_gradcam(image_path)
+        # Resize, colorize and blend the heatmap onto the image
+        return _blend_heatmap(original_img, heatmap)
     
-    def _generate_mock_gradcam(self, image_path):
+    def _generate_mock_gradcam(self, original_img):
         """Generate a mock Grad-CAM visualization for demonstration"""
         try:
-            # Load original image
-            original_img = cv2.imread(image_path)
             if original_img is None:
                 # Create a placeholder image
                 original_img = np.zeros((224, 224, 3), dtype=np.uint8)
             
-            original_img = cv2.cvtColor(original_img, cv2.COLOR_BGR2RGB)
-            
             # Create a simple mock heatmap (circular pattern in center)
             h, w = original_img.shape[:2]
-            center_x, center_y = w // 2, h // 2
-            
-            # Create circular gradient
-            y, x = np.ogrid[:h, :w]
-            mask = (x - center_x) ** 2 + (y - center_y) ** 2
-            mask = mask / mask.max()
-            
-            # Invert and normalize
-            heatmap = 1 - mask
-            heatmap = np.clip(heatmap, 0, 1)
+            heatmap = _radial_base_mask(h, w)
             
             # Add some randomness to make it look more realistic
-            noise = np.random.random((h, w)) * 0.3
-            heatmap = np.clip(heatmap + noise, 0, 1)
+            noise = _rng.random((h, w), dtype=np.float32)
+            noise *= 0.3
+            noise += heatmap
+            heatmap = np.clip(noise, 0, 1, out=noise)
             
-            # Apply colormap
-            heatmap_colored = cm.jet(heatmap)[:, :, :3]
-            heatmap_colored = (heatmap_colored * 255).astype(np.uint8)
-            
-            # Create overlay
-            overlay = cv2.addWeighted(original_img, 0.6, heatmap_colored, 0.4, 0)
+            # Colorize and blend the heatmap onto the image
+            overlay = _blend_heatmap(original_img, heatmap)
             
             return overlay
             
@@ -156,20 +262,26 @@ class GradCAM:
             # Return a simple placeholder
             return np.zeros((224, 224, 3), dtype=np.uint8)
     
-    def save_gradcam(self, image_path, output_path, class_index=None):
-        """Generate and save Grad-CAM visualization"""
+    def save_gradcam(self, original_img, output_path, class_index=None, img_array=None, activations=None):
+        """Generate and save Grad-CAM visualization
+        
+        Returns (saved, is_mock): whether the image was written, and whether it is the
+        mock visualization rather than a real Grad-CAM of the model.
+        """
         try:
-            gradcam_img = self.generate_gradcam(image_path, class_index)
+            gradcam_img, is_mock = self._generate(original_img, class_index, img_array, activations)
             
             # Convert RGB to BGR for OpenCV
             gradcam_bgr = cv2.cvtColor(gradcam_img, cv2.COLOR_RGB2BGR)
             
             # Save the image
-            cv2.imwrite(output_path, gradcam_bgr)
+            if not cv2.imwrite(output_path, gradcam_bgr):
+                print(f"Error saving Grad-CAM: could not write {output_path}")
+                return False, is_mock
             
-            return True
+            return True, is_mock
             
         except Exception as e:
             print(f"Error saving Grad-CAM: {e}")
-            return False
+            return False, True
 
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-15 09:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('classifier', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='brainscanupload',
+            name='gradcam_url',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
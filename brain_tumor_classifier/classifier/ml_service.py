@@ -1,17 +1,115 @@
+import os
+
+# Read by TensorFlow at import time, so it must be set first
+os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+
 import tensorflow as tf
 import numpy as np
 import cv2
-from PIL import Image
-import os
+import glob
+import queue
+import threading
+import time
 from django.conf import settings
 from .gradcam import GradCAM
 
+# XLA-compile the inference graphs; set CLASSIFIER_JIT_COMPILE=0 to run them unfused
+JIT_COMPILE = os.environ.get('CLASSIFIER_JIT_COMPILE', '1') == '1'
+
+# Concurrent predictions are collected for up to BATCH_WINDOW seconds into batches of MAX_BATCH
+MAX_BATCH = 8
+BATCH_WINDOW = 0.005
+# Batches are zero-padded up to one of these sizes so XLA only ever compiles (and we only
+# warm up) a fixed set of shapes instead of every size from 1 to MAX_BATCH
+BATCH_SIZES = (1, 2, 4, MAX_BATCH)
+
+# Serve predictions from an INT8-quantized TFLite copy of the model; opt in with CLASSIFIER_TFLITE=1
+USE_TFLITE = os.environ.get('CLASSIFIER_TFLITE', '0') == '1'
+# Number of uploaded scans used to calibrate the INT8 quantization ranges
+TFLITE_CALIBRATION_SAMPLES = 12
+
+
+def _configure_threading():
+    """Split the CPU between server workers instead of letting each one claim every core"""
+    workers = max(1, int(os.environ.get('WEB_CONCURRENCY', 1)))
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(max(1, (os.cpu_count() or 1) // workers))
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+    except RuntimeError as e:
+        # The TensorFlow runtime was already initialized elsewhere in this process
+        print(f"Could not configure TensorFlow threading: {e}")
+
+@tf.function(input_signature=[tf.TensorSpec([], tf.string)])
+def _preprocess_gpu(raw_bytes):
+    """Decode encoded image bytes and resize/normalize them into a (1, 224, 224, 3) batch
+    
+    Used when a GPU is available: decoding stays on the CPU, resize and normalize run on the device.
+    """
+    image = tf.io.decode_image(raw_bytes, channels=3, expand_animations=False)
+    image = tf.image.resize(image, [224, 224])
+    image = tf.cast(image, tf.float32) / 255.0
+    return tf.expand_dims(image, axis=0)
+
+
+def _pad_batch(batch):
+    """Zero-pad an (N, 224, 224, 3) batch up to the smallest size in BATCH_SIZES that fits it"""
+    n = len(batch)
+    size = next(size for size in BATCH_SIZES if size >= n)
+    if size == n:
+        return batch
+    padding = tf.zeros([size - n, 224, 224, 3], dtype=tf.float32)
+    return tf.concat([tf.convert_to_tensor(batch, dtype=tf.float32), padding], axis=0)
+
+
+class _PendingPrediction:
+    """A preprocessed image waiting for the batch worker, plus its result slot"""
+    def __init__(self, image):
+        self.image = image
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
 class BrainTumorClassifier:
     def __init__(self):
         self.model = None
         self.class_names = ['No Tumor', 'Tumor Present']
         self.gradcam = None
+        self._infer = None
+        self._tflite = None
+        self._infer_lock = threading.Lock()
+        self._request_queue = queue.Queue()
+        self._batch_thread = None
+        self._buffers = threading.local()
+        # Enumerating devices initializes CUDA, so only do it once the model is actually wanted
+        self._use_gpu = bool(tf.config.list_physical_devices('GPU'))
         self.load_model()
+        self._build_inference_fn()
+        if USE_TFLITE:
+            self._load_tflite()
+        self._start_batch_worker()
+        self.warmup()
+    
+    def warmup(self):
+        """Trace every graph on the serving path so no request pays compilation cost"""
+        if self._use_gpu:
+            try:
+                _preprocess_gpu.get_concrete_function()
+            except Exception as e:
+                print(f"Preprocessing warm-up failed: {e}")
+        
+        if self.gradcam is not None:
+            self.gradcam.warmup(BATCH_SIZES)
+        
+        # Predictions go through the Grad-CAM forward graph when it built, so only compile
+        # the plain inference graph when that is what requests will actually run
+        if self._infer is not None and not (self.gradcam is not None and self.gradcam.has_graph):
+            try:
+                for size in BATCH_SIZES:
+                    self._infer(tf.zeros([size, 224, 224, 3], dtype=tf.float32))
+            except Exception as e:
+                print(f"Graph inference warm-up failed, disabling it: {e}")
+                self._infer = None
     
     def load_model(self):
         """Load the pre-trained brain tumor classification model"""
@@ -40,7 +138,7 @@ class BrainTumorClassifier:
             if self.model is not None:
                 print(f"Model loaded successfully from {model_path}")
                 # Initialize Grad-CAM
-                self.gradcam = GradCAM(self.model)
+                self.gradcam = GradCAM(self.model, jit_compile=JIT_COMPILE)
             
         except Exception as e:
             print(f"Error loading model: {e}")
@@ -48,7 +146,187 @@ class BrainTumorClassifier:
             self.model = self._create_fallback_model()
             print("Using fallback model for demonstration")
             if self.model is not None:
-                self.gradcam = GradCAM(self.model)
+                self.gradcam = GradCAM(self.model, jit_compile=JIT_COMPILE)
+    
+    def _build_inference_fn(self):
+        """Wrap the forward pass in a traced graph; warmup() compiles it for each batch size"""
+        if self.model is None:
+            return
+        
+        try:
+            model = self.model
+            self._infer = tf.function(
+                lambda x: model(x, training=False),
+                jit_compile=JIT_COMPILE,
+                input_signature=[tf.TensorSpec([None, 224, 224, 3], tf.float32)]
+            )
+        except Exception as e:
+            print(f"Could not build graph inference function: {e}")
+            self._infer = None
+    
+    def _load_tflite(self):
+        """Load the INT8 TFLite model, converting and caching it on disk if needed"""
+        if self.model is None:
+            return
+        
+        try:
+            model_path = os.path.join(settings.BASE_DIR, 'tumor_model.h5')
+            tflite_path = os.path.join(settings.BASE_DIR, 'tumor_model_int8.tflite')
+            
+            if (os.path.exists(model_path) and os.path.exists(tflite_path)
+                    and os.path.getmtime(tflite_path) >= os.path.getmtime(model_path)):
+                with open(tflite_path, 'rb') as f:
+                    tflite_model = f.read()
+            else:
+                tflite_model = self._convert_to_tflite()
+                if tflite_model is None:
+                    return
+                # Only cache conversions of the real model, not the demonstration fallback
+                if os.path.exists(model_path):
+                    try:
+                        with open(tflite_path, 'wb') as f:
+                            f.write(tflite_model)
+                    except OSError as e:
+                        # Keep serving the converted model; it is just rebuilt on the next start
+                        print(f"Could not cache TFLite model at {tflite_path}: {e}")
+            
+            self._tflite = tf.lite.Interpreter(model_content=tflite_model)
+            self._tflite.allocate_tensors()
+            print("Serving predictions from INT8 TFLite model")
+        except Exception as e:
+            print(f"Could not load TFLite model, using Keras model: {e}")
+            self._tflite = None
+    
+    def _convert_to_tflite(self):
+        """Quantize the Keras model to INT8, calibrating on previously uploaded scans"""
+        pattern = os.path.join(settings.MEDIA_ROOT, 'uploads', '*')
+        sample_paths = sorted(glob.glob(pattern))[:TFLITE_CALIBRATION_SAMPLES]
+        samples = []
+        for path in sample_paths:
+            sample = self.preprocess_image(path)
+            # preprocess_image reuses its output buffer, so copy before the next call overwrites it
+            if sample is not None:
+                samples.append(np.array(sample))
+        # Ranges fitted to a couple of scans clip everything else, and the result would be cached
+        if len(samples) < TFLITE_CALIBRATION_SAMPLES:
+            print(f"Only {len(samples)} of {TFLITE_CALIBRATION_SAMPLES} uploaded scans available to "
+                  f"calibrate INT8 quantization, using Keras model")
+            return None
+        
+        def representative_dataset():
+            for sample in samples:
+                yield [sample]
+        
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        return converter.convert()
+    
+    def _run_tflite(self, batch):
+        """Run an (N, 224, 224, 3) float batch through the INT8 interpreter one image at a time"""
+        input_details = self._tflite.get_input_details()[0]
+        output_details = self._tflite.get_output_details()[0]
+        in_scale, in_zero_point = input_details['quantization']
+        out_scale, out_zero_point = output_details['quantization']
+        
+        quantized = np.clip(np.round(batch / in_scale + in_zero_point), 0, 255).astype(np.uint8)
+        predictions = []
+        for image in quantized:
+            self._tflite.set_tensor(input_details['index'], image[np.newaxis])
+            self._tflite.invoke()
+            output = self._tflite.get_tensor(output_details['index'])
+            if output_details['dtype'] != np.float32:
+                output = (output.astype(np.float32) - out_zero_point) * out_scale
+            predictions.append(output[0])
+        return np.stack(predictions)
+    
+    def _start_batch_worker(self):
+        """Start the background thread that runs queued predictions as batches"""
+        if self._infer is None and self._tflite is None:
+            return
+        
+        self._batch_thread = threading.Thread(target=self._batch_worker, name='classifier-batcher', daemon=True)
+        self._batch_thread.start()
+    
+    def _batch_worker(self):
+        """Collect pending predictions for a short window and run them as one batch"""
+        while True:
+            pending = [self._request_queue.get()]
+            deadline = time.monotonic() + BATCH_WINDOW
+            while len(pending) < MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._request_queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            try:
+                batch = np.concatenate([np.asarray(item.image) for item in pending])
+                with self._infer_lock:
+                    predictions, activations = self._run_model(batch)
+                for i, item in enumerate(pending):
+                    item_activations = None
+                    if activations is not None:
+                        item_activations = tuple(array[i] for array in activations)
+                    item.result = (predictions[i:i + 1], item_activations)
+            except Exception as e:
+                for item in pending:
+                    item.error = e
+            finally:
+                for item in pending:
+                    item.done.set()
+    
+    def _run_model(self, batch):
+        """Run the model on an (N, 224, 224, 3) batch
+        
+        Returns the predictions and, when the Grad-CAM graph is available, the per-image
+        (conv_outputs, pooled_grads) of the top class computed in the same forward pass.
+        """
+        if self._tflite is not None:
+            return self._run_tflite(np.asarray(batch)), None
+        
+        n = len(batch)
+        padded = _pad_batch(batch)
+        if self.gradcam is not None and self.gradcam.has_graph:
+            try:
+                predictions, conv_outputs, pooled_grads = self.gradcam.forward_with_grads(padded)
+                return predictions[:n], (conv_outputs[:n], pooled_grads[:n])
+            except Exception as e:
+                # A broken gradient path must only cost us Grad-CAM, not the classification
+                print(f"Grad-CAM forward pass failed, classifying without activations: {e}")
+        if self._infer is not None:
+            return self._infer(tf.convert_to_tensor(padded)).numpy()[:n], None
+        return self.model(batch, training=False).numpy(), None
+    
+    def _run_single(self, processed_image):
+        """Run a (1, 224, 224, 3) batch, unwrapping the activations of its only image"""
+        predictions, activations = self._run_model(processed_image)
+        if activations is not None:
+            activations = tuple(array[0] for array in activations)
+        return predictions, activations
+    
+    def _predict_batched(self, processed_image):
+        """Run a single preprocessed image, sharing a batch with concurrent requests"""
+        if self._batch_thread is None:
+            return self._run_single(processed_image)
+        
+        # Fast path: nothing else is waiting and the model is idle, so run inline
+        if self._request_queue.empty() and self._infer_lock.acquire(blocking=False):
+            try:
+                return self._run_single(processed_image)
+            finally:
+                self._infer_lock.release()
+        
+        pending = _PendingPrediction(processed_image)
+        self._request_queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
     
     def _create_fallback_model(self):
         """Create a simple fallback model for demonstration purposes"""
@@ -70,31 +348,39 @@ class BrainTumorClassifier:
             return None
     
     def preprocess_image(self, image_path):
-        """Preprocess the image for model prediction"""
+        """Preprocess the image for model prediction
+        
+        On CPU the returned batch lives in a per-thread buffer that is overwritten by
+        the next call on the same thread; copy it if it must outlive the request.
+        """
         try:
+            if self._use_gpu:
+                return _preprocess_gpu(tf.io.read_file(image_path))
+            
             # Load image
             image = cv2.imread(image_path)
             if image is None:
                 raise ValueError("Could not load image")
             
-            # Convert BGR to RGB
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            
-            # Resize to model input size (assuming 224x224, adjust if needed)
-            image = cv2.resize(image, (224, 224))
-            
-            # Normalize pixel values
-            image = image.astype(np.float32) / 255.0
-            
-            # Add batch dimension
-            image = np.expand_dims(image, axis=0)
-            
-            return image
+            return self._to_model_input(image)
         except Exception as e:
             print(f"Error preprocessing image: {e}")
             return None
     
-    def predict(self, image_path):
+    def _to_model_input(self, image):
+        """Resize and normalize a decoded BGR image into this thread's model input buffer"""
+        # Resize the 3-byte pixels before anything else touches the full-size image
+        image = cv2.resize(image, (224, 224))
+        
+        buffer = getattr(self._buffers, 'input', None)
+        if buffer is None:
+            buffer = self._buffers.input = np.empty((1, 224, 224, 3), dtype=np.float32)
+        
+        # BGR to RGB through a reversed view, normalized straight into the buffer
+        np.multiply(image[..., ::-1], np.float32(1 / 255.0), out=buffer[0], casting='unsafe')
+        return buffer
+    
+    def predict(self, image_path, scan_id=None):
         """Make prediction on brain scan image"""
         try:
             # Preprocess image
@@ -104,7 +390,11 @@ class BrainTumorClassifier:
             
             if self.model is not None:
                 # Make prediction with loaded model
-                predictions = self.model.predict(processed_image)
+                predictions, activations = self._predict_batched(processed_image)
+                
+                # Keep the Grad-CAM activations so the visualization needs no second forward pass
+                if scan_id is not None and activations is not None:
+                    self._save_activations(scan_id, *activations)
                 
                 # Get predicted class and confidence
                 if len(predictions[0]) == 1:  # Binary classification with sigmoid
@@ -163,21 +453,102 @@ class BrainTumorClassifier:
         except:
             return "Could not get model summary"
     
-    def generate_gradcam_visualization(self, image_path, output_path):
-        """Generate Grad-CAM visualization for the given image"""
+    def _activation_cache_path(self, scan_id):
+        return os.path.join(settings.MEDIA_ROOT, 'gradcam_cache', f"{scan_id}.npz")
+    
+    def _save_activations(self, scan_id, conv_outputs, pooled_grads):
+        """Store the Grad-CAM activations of a scan for later visualization"""
+        cache_path = self._activation_cache_path(scan_id)
+        try:
+            try:
+                np.savez(cache_path, conv_outputs=conv_outputs, pooled_grads=pooled_grads)
+            except FileNotFoundError:
+                # The directory is normally created at startup; recreate it if it has gone missing
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                np.savez(cache_path, conv_outputs=conv_outputs, pooled_grads=pooled_grads)
+        except Exception as e:
+            print(f"Error caching Grad-CAM activations: {e}")
+    
+    def _load_activations(self, scan_id, not_before=None):
+        """Load the Grad-CAM activations stored at prediction time, if any
+        
+        Files older than the not_before timestamp belong to an earlier scan that had
+        the same id (e.g. after a database reset) and are ignored.
+        """
+        cache_path = self._activation_cache_path(scan_id)
+        if not os.path.exists(cache_path):
+            return None
+        if not_before is not None and os.path.getmtime(cache_path) < not_before:
+            return None
+        
+        try:
+            with np.load(cache_path) as cached:
+                return cached['conv_outputs'], cached['pooled_grads']
+        except Exception as e:
+            print(f"Error loading cached Grad-CAM activations: {e}")
+            return None
+    
+    def discard_activations(self, scan_id):
+        """Delete the stored Grad-CAM activations of a scan once its visualization is saved"""
+        try:
+            os.remove(self._activation_cache_path(scan_id))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Error deleting cached Grad-CAM activations: {e}")
+    
+    def generate_gradcam_visualization(self, image_path, output_path, scan_id=None, uploaded_at=None):
+        """Generate Grad-CAM visualization for the given image
+        
+        uploaded_at is the scan's upload timestamp; cached activations older than it are stale.
+        Returns (saved, is_mock) as reported by GradCAM.save_gradcam.
+        """
         try:
+            # Decode the scan once; it feeds both the overlay and, if needed, the model input
+            original_img = None
+            image = cv2.imread(image_path)
+            if image is not None:
+                original_img = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            
+            activations = None
+            processed_image = None
+            if scan_id is not None:
+                activations = self._load_activations(scan_id, not_before=uploaded_at)
+            if activations is None and image is not None:
+                processed_image = self._to_model_input(image)
+            
             if self.gradcam is None:
                 # Create a new GradCAM instance if not available
-                self.gradcam = GradCAM(self.model)
+                self.gradcam = GradCAM(self.model, jit_compile=JIT_COMPILE)
             
             # Generate and save Grad-CAM
-            success = self.gradcam.save_gradcam(image_path, output_path)
-            return success
+            return self.gradcam.save_gradcam(
+                original_img, output_path, img_array=processed_image, activations=activations
+            )
             
         except Exception as e:
             print(f"Error generating Grad-CAM visualization: {e}")
-            return False
+            return False, True
+
+# Global classifier instance, created on first use so that management commands like
+# migrate, which import this module through the URL checks, never initialize the
+# TensorFlow runtime or load the model
+_classifier = None
+_classifier_lock = threading.Lock()
 
-# Global classifier instance
-classifier = BrainTumorClassifier()
+
+def get_classifier():
+    """Return the shared classifier, loading the model on the first call
+    
+    TensorFlow, XLA and numba thread pools are not fork-safe, so this must first be
+    called in the process that serves requests, never in a pre-fork server master.
+    """
+    global _classifier
+    if _classifier is None:
+        with _classifier_lock:
+            if _classifier is None:
+                # Thread pools can only be sized before the TensorFlow runtime starts
+                _configure_threading()
+                _classifier = BrainTumorClassifier()
+    return _classifier
 
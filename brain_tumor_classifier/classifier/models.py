@@ -7,6 +7,7 @@ class BrainScanUpload(models.Model):
     uploaded_at = models.DateTimeField(auto_now_add=True)
     prediction = models.CharField(max_length=50, blank=True, null=True)
     confidence = models.FloatField(blank=True, null=True)
+    gradcam_url = models.CharField(max_length=255, blank=True, null=True)
     
     def __str__(self):
         return f"Brain Scan - {self.uploaded_at.strftime('%Y-%m-%d %H:%M')}"
@@ -1,3 +1,287 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+from unittest import mock, skipIf
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from . import gradcam, ml_service, views
+from .models import BrainScanUpload
+from .gradcam import GradCAM, JET_LUT, _blend_heatmap, _build_jet_lut, _fuse_overlay_numpy, _radial_base_mask
+
+
+class BlendHeatmapTests(SimpleTestCase):
+    def test_blend_rounds_3_to_2_mix_to_nearest(self):
+        original = np.array([[[1, 2, 3]]], dtype=np.uint8)
+        heatmap_u8 = np.zeros((1, 1), dtype=np.uint8)
+        lut = np.zeros((256, 3), dtype=np.uint8)
+        out = np.empty_like(original)
+
+        gradcam._fuse_overlay(original, heatmap_u8, lut, out)
+
+        # 0.6 * (1, 2, 3) = (0.6, 1.2, 1.8)
+        np.testing.assert_array_equal(out, [[[1, 1, 2]]])
+
+    @skipIf(gradcam._fuse_overlay is _fuse_overlay_numpy, "numba is not installed")
+    def test_numba_kernel_matches_numpy_fallback(self):
+        rng = np.random.default_rng(0)
+        original = rng.integers(0, 256, (17, 23, 3), dtype=np.uint8)
+        heatmap_u8 = rng.integers(0, 256, (17, 23), dtype=np.uint8)
+        numba_out = np.empty_like(original)
+        numpy_out = np.empty_like(original)
+
+        gradcam._fuse_overlay(original, heatmap_u8, JET_LUT, numba_out)
+        _fuse_overlay_numpy(original, heatmap_u8, JET_LUT, numpy_out)
+
+        np.testing.assert_array_equal(numba_out, numpy_out)
+
+    def test_blend_resizes_heatmap_to_image(self):
+        original = np.full((40, 30, 3), 100, dtype=np.uint8)
+        out = _blend_heatmap(original, np.ones((7, 7), dtype=np.float32))
+
+        self.assertEqual(out.shape, original.shape)
+        self.assertEqual(out.dtype, np.uint8)
+        expected = (3 * 100 + 2 * JET_LUT[255].astype(np.int32) + 2) // 5
+        np.testing.assert_array_equal(out[20, 15], expected)
+
+    def test_blend_treats_nan_heatmap_as_zero(self):
+        original = np.zeros((4, 4, 3), dtype=np.uint8)
+        out = _blend_heatmap(original, np.full((4, 4), np.nan, dtype=np.float32))
+
+        expected = (2 * JET_LUT[0].astype(np.int32) + 2) // 5
+        np.testing.assert_array_equal(out[0, 0], expected)
+
+class RadialBaseMaskTests(SimpleTestCase):
+    def test_mask_peaks_at_centre_and_falls_to_zero(self):
+        mask = _radial_base_mask(5, 5)
+
+        self.assertEqual(mask.shape, (5, 5))
+        self.assertEqual(mask.dtype, np.float32)
+        self.assertEqual(mask[2, 2], 1)
+        self.assertEqual(mask[0, 0], 0)
+        self.assertTrue(((mask >= 0) & (mask <= 1)).all())
+
+    def test_mask_is_cached_per_size(self):
+        self.assertIs(_radial_base_mask(6, 8), _radial_base_mask(6, 8))
+
+class HeatmapFromActivationsTests(SimpleTestCase):
+    def test_all_zero_activations_give_zero_heatmap(self):
+        heatmap = GradCAM.heatmap_from_activations(
+            np.zeros((7, 7, 16), dtype=np.float32), np.zeros(16, dtype=np.float32)
+        )
+
+        self.assertEqual(heatmap.shape, (7, 7))
+        self.assertFalse(np.isnan(heatmap).any())
+        self.assertEqual(heatmap.max(), 0)
+
+    def test_heatmap_is_normalized_and_clipped(self):
+        conv_outputs = np.array([[[1.0, 0.0], [0.0, 1.0]]], dtype=np.float32)
+        pooled_grads = np.array([2.0, -1.0], dtype=np.float32)
+
+        heatmap = GradCAM.heatmap_from_activations(conv_outputs, pooled_grads)
+
+        np.testing.assert_allclose(heatmap, [[1.0, 0.0]])
+
+class GetClassifierTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(ml_service, '_classifier', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_returns_single_instance_across_threads(self):
+        results = []
+        with mock.patch.object(ml_service, 'BrainTumorClassifier') as classifier_cls, \
+                mock.patch.object(ml_service, '_configure_threading'):
+            threads = [
+                threading.Thread(target=lambda: results.append(ml_service.get_classifier()))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        classifier_cls.assert_called_once_with()
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(result is classifier_cls.return_value for result in results))
+
+class JetLutTests(SimpleTestCase):
+    def test_lut_shape_and_endpoints(self):
+        lut = _build_jet_lut()
+
+        self.assertEqual(lut.shape, (256, 3))
+        self.assertEqual(lut.dtype, np.uint8)
+        # Jet runs from dark blue to dark red
+        np.testing.assert_array_equal(lut[0], [0, 0, 127])
+        np.testing.assert_array_equal(lut[255], [127, 0, 0])
+
+
+def _bare_classifier():
+    """A BrainTumorClassifier with its batching state set up but no model loaded"""
+    classifier = ml_service.BrainTumorClassifier.__new__(ml_service.BrainTumorClassifier)
+    classifier.model = None
+    classifier.gradcam = None
+    classifier._infer = None
+    classifier._tflite = None
+    classifier._infer_lock = threading.Lock()
+    classifier._request_queue = ml_service.queue.Queue()
+    classifier._batch_thread = None
+    classifier._buffers = threading.local()
+    return classifier
+
+
+class BatchingTests(SimpleTestCase):
+    def _start_worker(self, classifier):
+        classifier._batch_thread = threading.Thread(target=classifier._batch_worker, daemon=True)
+        classifier._batch_thread.start()
+
+    def test_worker_fans_results_out_by_index(self):
+        classifier = _bare_classifier()
+        classifier._run_model = mock.Mock(side_effect=lambda batch: (batch * 10, (batch + 1, batch + 2)))
+        pending = [ml_service._PendingPrediction(np.full((1, 2), i, dtype=np.float32)) for i in range(3)]
+        for item in pending:
+            classifier._request_queue.put(item)
+
+        self._start_worker(classifier)
+        for item in pending:
+            self.assertTrue(item.done.wait(5))
+
+        classifier._run_model.assert_called_once()
+        for i, item in enumerate(pending):
+            self.assertIsNone(item.error)
+            predictions, (conv_outputs, pooled_grads) = item.result
+            np.testing.assert_array_equal(predictions, [[10 * i, 10 * i]])
+            np.testing.assert_array_equal(conv_outputs, [i + 1, i + 1])
+            np.testing.assert_array_equal(pooled_grads, [i + 2, i + 2])
+
+    def test_batch_error_is_raised_in_every_waiting_request(self):
+        classifier = _bare_classifier()
+        error = ValueError("model failed")
+        classifier._run_model = mock.Mock(side_effect=error)
+        # A request already waiting keeps the caller off the inline fast path
+        blocker = ml_service._PendingPrediction(np.zeros((1, 2), dtype=np.float32))
+        classifier._request_queue.put(blocker)
+        classifier._batch_thread = threading.Thread(target=classifier._batch_worker, daemon=True)
+
+        raised = []
+        def predict():
+            try:
+                classifier._predict_batched(np.ones((1, 2), dtype=np.float32))
+            except Exception as e:
+                raised.append(e)
+        caller = threading.Thread(target=predict)
+        caller.start()
+        while classifier._request_queue.qsize() < 2:
+            caller.join(0.001)
+        classifier._batch_thread.start()
+        caller.join(5)
+
+        self.assertEqual(raised, [error])
+        self.assertIs(blocker.error, error)
+
+    def test_idle_model_runs_inline(self):
+        classifier = _bare_classifier()
+        classifier._batch_thread = mock.Mock()
+        activations = (np.ones((1, 7, 7, 4)), np.ones((1, 4)))
+        classifier._run_model = mock.Mock(return_value=(np.array([[0.9]]), activations))
+        image = np.zeros((1, 224, 224, 3), dtype=np.float32)
+
+        predictions, (conv_outputs, pooled_grads) = classifier._predict_batched(image)
+
+        classifier._run_model.assert_called_once_with(image)
+        np.testing.assert_array_equal(predictions, [[0.9]])
+        self.assertEqual(conv_outputs.shape, (7, 7, 4))
+        self.assertEqual(pooled_grads.shape, (4,))
+        self.assertTrue(classifier._request_queue.empty())
+        self.assertFalse(classifier._infer_lock.locked())
+
+    def test_pad_batch_rounds_up_to_a_compiled_size(self):
+        batch = np.ones((3, 224, 224, 3), dtype=np.float32)
+
+        padded = np.asarray(ml_service._pad_batch(batch))
+
+        self.assertEqual(padded.shape, (4, 224, 224, 3))
+        self.assertTrue((padded[:3] == 1).all())
+        self.assertTrue((padded[3] == 0).all())
+        self.assertIs(ml_service._pad_batch(padded), padded)
+
+    def test_padded_rows_are_sliced_off_the_predictions(self):
+        classifier = _bare_classifier()
+        seen_sizes = []
+        def infer(batch):
+            seen_sizes.append(int(batch.shape[0]))
+            return ml_service.tf.reduce_mean(batch, axis=[1, 2, 3])[:, None]
+        classifier._infer = infer
+        batch = np.stack([np.full((224, 224, 3), i, dtype=np.float32) for i in (1, 2, 3)])
+
+        predictions, activations = classifier._run_model(batch)
+
+        self.assertEqual(seen_sizes, [4])
+        np.testing.assert_allclose(predictions, [[1], [2], [3]])
+        self.assertIsNone(activations)
+
+
+class ModelInputTests(SimpleTestCase):
+    def test_matches_cvtcolor_and_float_division(self):
+        classifier = _bare_classifier()
+        image = np.random.default_rng(0).integers(0, 256, (300, 260, 3), dtype=np.uint8)
+        expected = np.expand_dims(
+            cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2RGB), (224, 224)).astype(np.float32) / 255.0, 0
+        )
+
+        model_input = classifier._to_model_input(image)
+
+        self.assertEqual(model_input.shape, (1, 224, 224, 3))
+        self.assertEqual(model_input.dtype, np.float32)
+        np.testing.assert_allclose(model_input, expected, rtol=1e-6)
+
+    def test_reuses_the_thread_buffer(self):
+        classifier = _bare_classifier()
+        image = np.zeros((224, 224, 3), dtype=np.uint8)
+
+        first = classifier._to_model_input(image)
+        second = classifier._to_model_input(image + 255)
+
+        self.assertIs(first, second)
+        np.testing.assert_allclose(second, 1, rtol=1e-6)
+
+
+class GetGradcamViewTests(TestCase):
+    def setUp(self):
+        gradcam_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(gradcam_dir.cleanup)
+        self.gradcam_dir = gradcam_dir.name
+        patcher = mock.patch.object(views, 'GRADCAM_DIR', self.gradcam_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scan = BrainScanUpload.objects.create(image='uploads/scan.png')
+
+    def test_recorded_gradcam_url_is_served_without_the_classifier(self):
+        self.scan.gradcam_url = '/media/gradcam/gradcam_recorded.png'
+        self.scan.save()
+
+        with mock.patch.object(views, 'get_classifier') as get_classifier:
+            response = self.client.get(reverse('classifier:get_gradcam', args=[self.scan.id]))
+
+        get_classifier.assert_not_called()
+        self.assertEqual(response.json()['gradcam_url'], '/media/gradcam/gradcam_recorded.png')
+
+    def test_mock_gradcam_is_never_recorded(self):
+        def render_mock(image_path, output_path, **kwargs):
+            with open(output_path, 'wb') as f:
+                f.write(b'mock')
+            return True, True
+
+        with mock.patch.object(views, 'get_classifier') as get_classifier:
+            get_classifier.return_value.generate_gradcam_visualization.side_effect = render_mock
+            response = self.client.get(reverse('classifier:get_gradcam', args=[self.scan.id]))
+
+        self.assertTrue(response.json()['gradcam_url'].endswith(f"gradcam_{self.scan.id}_mock.png"))
+        self.scan.refresh_from_db()
+        self.assertIsNone(self.scan.gradcam_url)
+        # Only the mock is left behind: nothing at the cached path and no temporary file
+        self.assertEqual(os.listdir(self.gradcam_dir), [f"gradcam_{self.scan.id}_mock.png"])
+        get_classifier.return_value.discard_activations.assert_not_called()
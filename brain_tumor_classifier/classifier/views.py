@@ -7,8 +7,12 @@ from django.core.files.base import ContentFile
 from django.conf import settings
 import json
 import os
+import uuid
 from .models import BrainScanUpload
-from .ml_service import classifier
+from .ml_service import get_classifier
+
+# Where Grad-CAM visualizations are written; created in ClassifierConfig.ready()
+GRADCAM_DIR = os.path.join(settings.MEDIA_ROOT, 'gradcam')
 
 def home(request):
     """Home page view"""
@@ -39,8 +43,8 @@ def upload_and_predict(request):
         # Get full path to the uploaded image
         image_path = brain_scan.image.path
         
-        # Make prediction
-        prediction, confidence = classifier.predict(image_path)
+        # Make prediction, storing the Grad-CAM activations for this scan along the way
+        prediction, confidence = get_classifier().predict(image_path, scan_id=brain_scan.id)
         
         if prediction is None:
             return JsonResponse({'error': 'Failed to make prediction'}, status=500)
@@ -78,34 +82,65 @@ def scan_history(request):
         'scans': scans
     })
 
+def _gradcam_response(gradcam_url):
+    return JsonResponse({
+        'success': True,
+        'gradcam_url': gradcam_url,
+        'message': 'Grad-CAM visualization generated successfully'
+    })
+
 @csrf_exempt
 def get_gradcam(request, scan_id):
     """Generate and return Grad-CAM visualization"""
     try:
         scan = BrainScanUpload.objects.get(id=scan_id)
         
+        # Serve the previously generated visualization if there is one
+        if scan.gradcam_url:
+            return _gradcam_response(scan.gradcam_url)
+        
         # Create output path for Grad-CAM image
         gradcam_filename = f"gradcam_{scan_id}.png"
-        gradcam_path = os.path.join(settings.MEDIA_ROOT, 'gradcam', gradcam_filename)
+        gradcam_path = os.path.join(GRADCAM_DIR, gradcam_filename)
+        gradcam_url = f"{settings.MEDIA_URL}gradcam/{gradcam_filename}"
         
-        # Create gradcam directory if it doesn't exist
-        os.makedirs(os.path.dirname(gradcam_path), exist_ok=True)
+        # Files generated before gradcam_url was recorded are still valid if newer than the scan
+        if os.path.exists(gradcam_path) and os.path.getmtime(gradcam_path) >= scan.uploaded_at.timestamp():
+            scan.gradcam_url = gradcam_url
+            scan.save(update_fields=['gradcam_url'])
+            return _gradcam_response(gradcam_url)
         
-        # Generate Grad-CAM visualization
-        success = classifier.generate_gradcam_visualization(scan.image.path, gradcam_path)
+        # Render to a path private to this request and only then move it into place, so
+        # concurrent requests never clobber each other and a mock never lands on gradcam_path
+        temp_path = os.path.join(GRADCAM_DIR, f"gradcam_{scan_id}.{uuid.uuid4().hex}.tmp.png")
         
-        if success:
-            gradcam_url = f"{settings.MEDIA_URL}gradcam/{gradcam_filename}"
-            return JsonResponse({
-                'success': True,
-                'gradcam_url': gradcam_url,
-                'message': 'Grad-CAM visualization generated successfully'
-            })
+        # Generate Grad-CAM visualization from the activations stored at upload time, or
+        # failing that by running the Grad-CAM graph on the scan
+        success, is_mock = get_classifier().generate_gradcam_visualization(
+            scan.image.path, temp_path,
+            scan_id=scan_id, uploaded_at=scan.uploaded_at.timestamp()
+        )
+        
+        if not success:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        elif is_mock:
+            # Show the placeholder, but keep it out of the cached path so it is never reused
+            mock_filename = f"gradcam_{scan_id}_mock.png"
+            os.replace(temp_path, os.path.join(GRADCAM_DIR, mock_filename))
+            return _gradcam_response(f"{settings.MEDIA_URL}gradcam/{mock_filename}")
         else:
-            return JsonResponse({
-                'success': False,
-                'error': 'Failed to generate Grad-CAM visualization'
-            }, status=500)
+            os.replace(temp_path, gradcam_path)
+            scan.gradcam_url = gradcam_url
+            scan.save(update_fields=['gradcam_url'])
+            # The rendered image is served from now on, so the activations are no longer needed
+            get_classifier().discard_activations(scan_id)
+            return _gradcam_response(gradcam_url)
+        
+        return JsonResponse({
+            'success': False,
+            'error': 'Failed to generate Grad-CAM visualization'
+        }, status=500)
         
     except BrainScanUpload.DoesNotExist:
         return JsonResponse({'error': 'Scan not found'}, status=404)
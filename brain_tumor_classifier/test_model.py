@@ -10,10 +10,11 @@ sys.path.append('/home/ubuntu/brain_tumor_classifier')
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'brain_tumor_classifier.settings')
 django.setup()
 
-from classifier.ml_service import classifier
+from classifier.ml_service import get_classifier
 
 def test_model():
     print("Testing brain tumor classification model...")
+    classifier = get_classifier()
     
     # Test model loading
     if classifier.model is None: